@@ -1,16 +1,91 @@
-from collections import namedtuple
+from collections.abc import Callable
+from concurrent.futures import ThreadPoolExecutor
 
 import gymnasium as gym
 import numpy as np
 import torch
 import torch.nn as nn
+from numba import njit
 from omegaconf import DictConfig
-from torch.distributions import Categorical
+from torch import Tensor
 from torch.nn.functional import smooth_l1_loss
 
 from src.policy_model import PolicyModel
 
-Rollout = namedtuple("Rollout", ["log_prob", "value", "reward", "done"])
+
+@njit(cache=True, fastmath=True)
+def normalized_returns(
+    rewards: np.ndarray, dones: np.ndarray, valid: np.ndarray, gamma: float, eps: float
+) -> np.ndarray:
+    """Discounted returns for (time, env) arrays, reset at episode boundaries and
+    standardized over the valid transitions."""
+    num_steps, num_envs = rewards.shape
+    returns = np.empty_like(rewards)
+    total = 0.0
+    count = 0
+    for env in range(num_envs):
+        cum_reward = 0.0
+        for t in range(num_steps - 1, -1, -1):
+            if dones[t, env]:
+                cum_reward = 0.0
+            cum_reward = rewards[t, env] + gamma * cum_reward
+            returns[t, env] = cum_reward
+            if valid[t, env]:
+                total += cum_reward
+                count += 1
+
+    mean = total / count
+    sq_dev = 0.0
+    for t in range(num_steps):
+        for env in range(num_envs):
+            if valid[t, env]:
+                sq_dev += (returns[t, env] - mean) ** 2
+    std = np.sqrt(sq_dev / (count - 1))
+
+    for t in range(num_steps):
+        for env in range(num_envs):
+            returns[t, env] = (returns[t, env] - mean) / (std + eps)
+    return returns
+
+
+def sample_actions(log_probs: Tensor) -> Tensor:
+    """Sample one action per row of (batch, action) log-probabilities."""
+    return torch.multinomial(log_probs.exp(), 1).squeeze(-1)
+
+
+def action_log_probs(log_probs: Tensor, actions: Tensor) -> Tensor:
+    """Select the log-probabilities of the taken actions."""
+    return log_probs.gather(-1, actions.unsqueeze(-1)).squeeze(-1)
+
+
+class CUDAGraphPolicy:
+    """Rollout forward pass (state -> action log-probs) captured into a CUDA graph.
+
+    For a small MLP each env step is dominated by kernel-launch latency, which a single graph
+    replay removes. Replay reads the parameters from their storage, so in-place optimizer
+    updates are picked up without recapturing.
+    """
+
+    def __init__(self, model: PolicyModel, example_state: Tensor):
+        self.model = model
+        self.static_state = example_state.clone()
+
+        # Warm up on a side stream so one-off allocations and autotuning are not captured
+        stream = torch.cuda.Stream()
+        stream.wait_stream(torch.cuda.current_stream())
+        with torch.cuda.stream(stream):
+            for _ in range(3):
+                model(self.static_state, return_log_probs=True)
+        torch.cuda.current_stream().wait_stream(stream)
+
+        self.graph = torch.cuda.CUDAGraph()
+        with torch.cuda.graph(self.graph):
+            self.static_log_probs, _ = model(self.static_state, return_log_probs=True)
+
+    def __call__(self, state: Tensor) -> Tensor:
+        self.static_state.copy_(state, non_blocking=True)
+        self.graph.replay()
+        return self.static_log_probs
 
 
 class REINFORCE:
@@ -20,82 +95,145 @@ class REINFORCE:
         self.seed = seed
         self.environment = environment
         self.config = config
-        self.rollouts: list[Rollout] = []
         self.eps = 1e-8
+        self.gamma_pow = config.gamma ** np.arange(config.rollout_length, dtype=np.float32)
+
+        # Rollout buffers, written by step index instead of appending per-step tuples.
+        # Sampling runs without autograd; update() recomputes log-probs and values in one
+        # batched forward over the stored states.
+        buffer_shape = (config.rollout_length, environment.num_envs)
+        state_space_size = environment.observation_space.shape[-1]
+        # Pinned so that the per-step copy of the current state to the GPU can be asynchronous
+        self.states = torch.empty(
+            (*buffer_shape, state_space_size), pin_memory=torch.cuda.is_available()
+        )
+        self.actions = torch.empty(buffer_shape, dtype=torch.long)
+        self.rewards = np.zeros(buffer_shape, dtype=np.float32)
+        self.dones = np.zeros(buffer_shape, dtype=bool)
+        # Vector envs autoreset on the step after `done`; that step's action is ignored and its
+        # reward is 0, so it must not contribute to the loss.
+        self.valid = np.ones(buffer_shape, dtype=bool)
+        self.has_rollout = False
+        self.graph_policy: CUDAGraphPolicy | None = None
+
+        # Videos come from a dedicated single env played on a worker thread, so the training
+        # rollout neither waits on pygame nor renders a frame for every vectorised env.
+        self.render_environment = gym.make(environment.spec.id, render_mode="rgb_array")
+        self.render_pool = ThreadPoolExecutor(max_workers=1)
 
     def update(self, model: nn.Module, optimizer: torch.optim.Optimizer):
         """Compute returns, normalize, and take a gradient step.
         Uses a value baseline (actor-critic-style) if provided by the model.
         """
-        if not self.rollouts:
+        if not self.has_rollout:
             return
 
         device = next(model.parameters()).device
 
-        # Compute discounted returns (from the end)
-        returns = []
-        cum_reward = 0.0
-        for _, _, reward, done in reversed(self.rollouts):
-            # r_val = r.item() if isinstance(r, torch.Tensor) else float(r)
-            cum_reward = reward + self.config.gamma * cum_reward * (1 - done.float())
-            returns.insert(0, cum_reward)
-
-        returns_t = torch.stack(returns).to(device)
-        # Normalize for variance reduction
-        returns_t = (returns_t - returns_t.mean()) / (returns_t.std() + self.eps)
-
-        policy_losses = []
-        value_losses = []
-
-        for (log_prob, value, _, _), return_t in zip(self.rollouts, returns_t, strict=True):
-            # Advantage using baseline
-            advantage = return_t - value.detach()
-            policy_losses.append(-log_prob * advantage)
-            value_losses.append(smooth_l1_loss(value, return_t))
-
-        loss = torch.stack(policy_losses).sum() + torch.stack(value_losses).sum()
+        log_probs, values = model(self.states.to(device), return_log_probs=True)
+        log_probs = action_log_probs(log_probs, self.actions.to(device))
+
+        # Compute discounted returns (from the end) and normalize them for variance reduction,
+        # using only the transitions of real episodes
+        returns = normalized_returns(
+            self.rewards, self.dones, self.valid, self.config.gamma, self.eps
+        )
+        returns_t = torch.from_numpy(returns).to(device)
+        valid = torch.from_numpy(self.valid).to(device)
+
+        # Advantage using baseline
+        advantages = (returns_t - values.detach()) * valid
+        policy_loss = -(log_probs * advantages).sum()
+        # Value loss is averaged over envs per step, then summed over time
+        value_loss = smooth_l1_loss(values, returns_t, reduction="none")
+        value_loss = (value_loss * valid).sum() / self.environment.num_envs
+
+        loss = policy_loss + value_loss
         optimizer.zero_grad()
         loss.backward()
         optimizer.step()
 
         # Clear trajectory
-        self.rollouts.clear()
+        self.has_rollout = False
 
     def sample_rollout(self, model: PolicyModel, device: torch.device, will_render: bool):
-        """Run one episode (or up to rollout_length) and store transitions.
-        Returns total_reward for logging.
+        """Step every env for rollout_length steps and store transitions.
+        Episodes that end early are autoreset by the vector env. Returns total_reward for logging.
         """
-        self.rollouts.clear()
+        # Resolved (and on first use, captured) before the render worker starts using the model
+        policy = self.rollout_policy(model, device)
+        render_job = (
+            self.render_pool.submit(self.render_episode, model, device) if will_render else None
+        )
         state, _ = self.environment.reset(seed=self.seed)
-        if isinstance(state, torch.Tensor):
-            state = state.to(device)
 
-        total_reward = 0.0
         terminated = False
         truncated = False
 
-        frames = None
-        if will_render:
-            frames = [self.environment.render()[0]]
+        autoreset = np.zeros(self.environment.num_envs, dtype=bool)
+        with torch.inference_mode():
+            for step in range(self.config.rollout_length):
+                # The policy copies the state to the device without blocking; the action sync
+                # below waits for that copy, so the pinned slot is never rewritten mid-transfer.
+                self.states[step] = torch.from_numpy(state)
+                log_probs = policy(self.states[step])
+                action = sample_actions(log_probs)
 
-        for step in range(self.config.rollout_length):
-            logits, value = model(state)
-            dist = Categorical(logits=logits)
-            action = dist.sample()
+                self.actions[step] = action
+                action_np = self.actions[step].numpy()
+                next_state, reward, terminated, truncated, _ = self.environment.step(action_np)
+                done = terminated | truncated
 
-            action_cpu = action.detach().to("cpu", dtype=torch.long)
-            next_state, reward, terminated, truncated, _ = self.environment.step(action_cpu)
-            done = terminated | truncated
+                self.rewards[step] = reward
+                self.dones[step] = done
+                self.valid[step] = ~autoreset
+                autoreset = self.dones[step]
 
-            self.rollouts.append(
-                Rollout(log_prob=dist.log_prob(action), value=value, reward=reward, done=done)
-            )
-            total_reward += reward * (self.config.gamma**step)
+                state = next_state
 
-            state = next_state.to(device)
+        self.has_rollout = True
+        total_reward = self.gamma_pow @ self.rewards
 
-            if will_render:
-                frames.append(self.environment.render()[0])
-
-        frames = np.stack(frames) if will_render else frames
+        frames = render_job.result() if will_render else None
         return total_reward, terminated, truncated, frames
+
+    def rollout_policy(
+        self, model: PolicyModel, device: torch.device
+    ) -> Callable[[Tensor], Tensor]:
+        """Map a host-side state batch to action log-probs, via a CUDA graph on CUDA devices.
+        torch.compile(mode="reduce-overhead") models already replay CUDA graphs themselves."""
+        if device.type != "cuda" or hasattr(model, "_orig_mod"):
+
+            def eager_policy(state: Tensor) -> Tensor:
+                log_probs, _ = model(state.to(device, non_blocking=True), return_log_probs=True)
+                return log_probs
+
+            return eager_policy
+
+        if self.graph_policy is None or self.graph_policy.model is not model:
+            example_state = torch.zeros(self.states.shape[1:], device=device)
+            with torch.inference_mode():
+                self.graph_policy = CUDAGraphPolicy(model, example_state)
+        return self.graph_policy
+
+    def render_episode(self, model: PolicyModel, device: torch.device) -> list[np.ndarray]:
+        """Play one greedy episode (as the frontend does) in the render env and return its frames."""
+        # Use the eager module: a compiled one would recompile for single states on this thread
+        model = getattr(model, "_orig_mod", model)
+        state, _ = self.render_environment.reset(seed=self.seed)
+        frames = [self.render_environment.render()]
+
+        with torch.inference_mode():
+            for _ in range(self.config.rollout_length):
+                logits, _ = model(torch.from_numpy(state).to(device))
+                action = logits.argmax(dim=-1).item()
+                state, _, terminated, truncated, _ = self.render_environment.step(action)
+                frames.append(self.render_environment.render())
+                if terminated or truncated:
+                    break
+
+        return frames
+
+    def close(self):
+        self.render_pool.shutdown()
+        self.render_environment.close()
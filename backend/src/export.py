@@ -1,19 +1,41 @@
+import logging
+import tempfile
 from pathlib import Path
 
 import hydra
+import numpy as np
+import onnxruntime as ort
 import torch
 from omegaconf import DictConfig
+from onnxruntime.quantization import QuantType, quantize_dynamic
+from onnxruntime.quantization.shape_inference import quant_pre_process
 
 from src.policy_model import PolicyModel
 
+logger = logging.getLogger(__name__)
+
+
+def action_agreement(fp32_path: Path, int8_path: Path, states: np.ndarray) -> float:
+    """Fraction of states for which both ONNX models pick the same (argmax) action."""
+    fp32_session = ort.InferenceSession(fp32_path, providers=["CPUExecutionProvider"])
+    int8_session = ort.InferenceSession(int8_path, providers=["CPUExecutionProvider"])
+    input_name = fp32_session.get_inputs()[0].name
+
+    matches = 0
+    for state in states:
+        fp32_logits = fp32_session.run(None, {input_name: state})[0]
+        int8_logits = int8_session.run(None, {input_name: state})[0]
+        matches += int(fp32_logits.argmax() == int8_logits.argmax())
+    return matches / len(states)
+
 
 @hydra.main(version_base=None, config_path="../config", config_name="export")
 def main(config: DictConfig):
     model_path = Path(config.model_path)
     state_dict = torch.load(model_path, map_location="cpu")
 
-    state_space_size = state_dict["torso.0.weight"].shape[1]
-    action_space_size = state_dict["head.weight"].shape[0] - 1
+    state_space_size = state_dict["fc1.weight"].shape[1]
+    action_space_size = state_dict["policy_head.weight"].shape[0]
 
     policy_model = PolicyModel(
         state_space_size=state_space_size, action_space_size=action_space_size
@@ -23,7 +45,24 @@ def main(config: DictConfig):
 
     example_inputs = (torch.randn(state_space_size),)
     onnx_program = torch.onnx.export(policy_model, example_inputs, dynamo=True)
-    onnx_program.save(model_path.with_suffix(".onnx"))
+    onnx_path = model_path.with_suffix(".onnx")
+    onnx_program.save(onnx_path)
+
+    if config.quantize:
+        # Dynamic quantization stores int8 weights and quantizes activations at runtime, so
+        # no calibration data is needed. Pre-processing re-runs shape inference, which the
+        # quantizer requires for the Gemm nodes emitted by the dynamo exporter.
+        int8_path = model_path.with_suffix(".int8.onnx")
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            preprocessed_path = Path(tmp_dir) / onnx_path.name
+            quant_pre_process(onnx_path, preprocessed_path)
+            quantize_dynamic(preprocessed_path, int8_path, weight_type=QuantType.QInt8)
+
+        # Accuracy check: the frontend acts greedily, so compare argmax actions on random states
+        rng = np.random.default_rng(0)
+        states = rng.standard_normal((config.num_check_states, state_space_size), np.float32)
+        agreement = action_agreement(onnx_path, int8_path, states)
+        logger.info(f"Saved int8 model to {int8_path} ({agreement:.1%} action agreement)")
 
 
 if __name__ == "__main__":
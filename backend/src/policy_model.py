@@ -1,4 +1,5 @@
 from torch import Tensor, nn
+from torch.nn.functional import linear, log_softmax, relu
 
 
 class PolicyModel(nn.Module):
@@ -7,31 +8,29 @@ class PolicyModel(nn.Module):
         self.state_space_size = state_space_size
         self.action_space_size = action_space_size
 
-        # Shared torso
-        self.torso = nn.Sequential(
-            nn.Linear(state_space_size, 128),
-            nn.ReLU(),
-            nn.Linear(128, 64),
-            nn.ReLU(),
-        )
+        # Shared torso, applied functionally in forward() to keep the call stack shallow
+        self.fc1 = nn.Linear(state_space_size, 128)
+        self.fc2 = nn.Linear(128, 64)
         # Separate heads
-        self.head = nn.Linear(64, action_space_size + 1)
+        self.policy_head = nn.Linear(64, action_space_size)
+        self.value_head = nn.Linear(64, 1)
 
-    def forward(self, state: Tensor) -> tuple[Tensor, Tensor]:
+    def forward(self, state: Tensor, return_log_probs: bool = False) -> tuple[Tensor, Tensor]:
         """
         Args:
             state (Tensor): The state of the environment. Shape: (batch_size, state_space_size)
                             or (state_space_size,) for single step.
+            return_log_probs (bool): Return normalized log-probabilities instead of raw logits.
 
         Returns:
-            Tensor: action logits. Shape: (batch_size, action_space_size) or (action_space_size,) for single step.
+            Tensor: action logits (or log-probabilities). Shape: (batch_size, action_space_size)
+                    or (action_space_size,) for single step.
             Tensor: state value. Shape: (batch_size,) or (,) for single step.
         """
-        if state.dim() == 1:
-            state = state.unsqueeze(0)
-
-        h = self.torso(state)
-        logits_and_value = self.head(h)
-        value = logits_and_value[..., -1]
-        logits = logits_and_value[..., : self.action_space_size]
+        h = relu(linear(state, self.fc1.weight, self.fc1.bias))
+        h = relu(linear(h, self.fc2.weight, self.fc2.bias))
+        logits = linear(h, self.policy_head.weight, self.policy_head.bias)
+        value = linear(h, self.value_head.weight, self.value_head.bias).squeeze(-1)
+        if return_log_probs:
+            return log_softmax(logits, dim=-1), value
         return logits, value
@@ -1,6 +1,7 @@
 import json
 import logging
 import random
+from concurrent.futures import Future, ThreadPoolExecutor
 from pathlib import Path
 
 import gymnasium as gym
@@ -8,7 +9,7 @@ import hydra
 import numpy as np
 import torch
 import wandb
-from gymnasium.wrappers.vector.numpy_to_torch import NumpyToTorch
+from moviepy import ImageSequenceClip
 from omegaconf import DictConfig, OmegaConf
 from torch import optim
 from tqdm import tqdm
@@ -20,14 +21,38 @@ logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
 
-if torch.cuda.is_available():
-    device = torch.device("cuda")
-elif torch.backends.mps.is_available():
-    device = torch.device("mps")
-else:
-    device = torch.device("cpu")
+# Below this observation size the policy MLP is so small that its forward pass takes
+# microseconds on the CPU. On an accelerator, kernel-launch latency and the per-env-step
+# host<->device syncs (actions have to reach the CPU-side env) cost more than the compute,
+# so the whole run stays on the CPU. Larger observation spaces prefer CUDA, then MPS.
+CPU_MAX_STATE_SPACE_SIZE = 32
 
-logger.info(f"Using device: {device}")
+
+def select_device(state_space_size: int) -> torch.device:
+    if state_space_size < CPU_MAX_STATE_SPACE_SIZE:
+        return torch.device("cpu")
+    if torch.cuda.is_available():
+        return torch.device("cuda")
+    if torch.backends.mps.is_available():
+        return torch.device("mps")
+    return torch.device("cpu")
+
+
+def encode_video(frames: list[np.ndarray], path: Path, fps: int) -> Path:
+    """Encode (height, width, channel) uint8 frames to an mp4 file."""
+    clip = ImageSequenceClip(frames, fps=fps)
+    clip.write_videofile(str(path), codec="libx264", audio=False, logger=None)
+    clip.close()
+    return path
+
+
+def log_encoded_videos(pending_videos: list[tuple[int, Future]], step: int, wait: bool = False):
+    """Log the videos whose background encode has finished (or all of them if `wait`)."""
+    for render_step, job in list(pending_videos):
+        if wait or job.done():
+            caption = f"Rollout at step {render_step}"
+            wandb.log({"video": wandb.Video(str(job.result()), caption=caption)}, step=step)
+            pending_videos.remove((render_step, job))
 
 
 @hydra.main(version_base=None, config_path="../config", config_name="reinforce")
@@ -35,6 +60,8 @@ def main(config: DictConfig):
     output_dir = Path(hydra.core.hydra_config.HydraConfig.get().runtime.output_dir)
     save_dir = output_dir / "checkpoints"
     save_dir.mkdir(parents=True, exist_ok=True)
+    video_dir = output_dir / "videos"
+    video_dir.mkdir(parents=True, exist_ok=True)
 
     torch.manual_seed(config.seed)
     np.random.seed(config.seed)
@@ -53,13 +80,11 @@ def main(config: DictConfig):
         logger.info("Wandb initialized successfully!")
 
     # Create environment
-    environment: gym.Env = NumpyToTorch(
-        gym.make_vec(
-            config.environment.name,
-            num_envs=config.environment.num_envs,
-            render_mode="rgb_array",
-            vectorization_mode=config.environment.vectorization_mode,
-        )
+    # The env stays numpy end to end; only states are converted to torch, by the algorithm
+    environment: gym.vector.VectorEnv = gym.make_vec(
+        config.environment.name,
+        num_envs=config.environment.num_envs,
+        vectorization_mode=config.environment.vectorization_mode,
     )
 
     # Cart-Pole-v1 state space size is 4:
@@ -67,12 +92,21 @@ def main(config: DictConfig):
 
     logger.info(f"Environment: {config.environment}")
 
+    state_space_size = environment.observation_space.shape[-1]
+    device = select_device(state_space_size)
+    logger.info(f"Using device: {device}")
+
     # Create algorithm
     policy_model = PolicyModel(
-        state_space_size=environment.observation_space.shape[-1],
+        state_space_size=state_space_size,
         action_space_size=environment.action_space.nvec[0],
     ).to(device)
     optimizer = optim.Adam(policy_model.parameters(), lr=config.trainer.learning_rate)
+    # The compiled wrapper shares parameters with policy_model, which stays the module that is
+    # checkpointed (its state_dict keys are not prefixed with `_orig_mod.`) and exported.
+    model = policy_model
+    if config.trainer.compile:
+        model = torch.compile(policy_model, mode="reduce-overhead", dynamic=False)
     algorithm = get_algorithm(environment, config.algorithm, config.seed)
     logger.info(f"Algorithm: {config.algorithm.name}")
 
@@ -85,6 +119,11 @@ def main(config: DictConfig):
     terminated = False
     truncated = False
 
+    # moviepy pipes frames to an ffmpeg subprocess, so a worker thread keeps the encode off the
+    # training loop without pickling every frame over to another process.
+    video_pool = ThreadPoolExecutor(max_workers=1)
+    pending_videos: list[tuple[int, Future]] = []
+
     for step in tqdm(range(1, config.trainer.num_steps + 1)):
         policy_model.train()
         will_render = step % config.trainer.render_every_n_steps == 0
@@ -92,19 +131,21 @@ def main(config: DictConfig):
 
         # Sample rollout
         total_reward, terminated, truncated, frames = algorithm.sample_rollout(
-            policy_model, device, will_render
+            model, device, will_render
         )
         total_reward = total_reward.mean().item()
-        algorithm.update(policy_model, optimizer)
+        algorithm.update(model, optimizer)
 
         # Log metrics to wandb (if enabled)
         if use_wandb:
             wandb.log({"step": step, "episode_reward": total_reward}, step=step)
 
             if will_render:
-                frames = frames.transpose(0, 3, 1, 2)
-                video = wandb.Video(frames, fps=config.trainer.render_fps, format="mp4")
-                wandb.log({"video": video}, step=step)
+                video_path = video_dir / f"rollout_step_{step}.mp4"
+                job = video_pool.submit(encode_video, frames, video_path, config.trainer.render_fps)
+                pending_videos.append((step, job))
+
+            log_encoded_videos(pending_videos, step)
 
         running_total_reward = 0.99 * running_total_reward + 0.01 * total_reward
 
@@ -134,9 +175,12 @@ def main(config: DictConfig):
 
     # Cleanup
     logger.info("Training completed!")
+    algorithm.close()
     environment.close()
 
     if use_wandb:
+        log_encoded_videos(pending_videos, config.trainer.num_steps, wait=True)
+        video_pool.shutdown()
         wandb.finish()
         logger.info("Wandb run finished.")
 